@@ -1,9 +1,15 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import cma
-from gymnasium import Env
+from gymnasium import Env, make
+from gymnasium.envs.classic_control import CartPoleEnv
+from gymnasium.envs.registration import EnvSpec
+from gymnasium.vector import SyncVectorEnv, VectorEnv
 
 import numpy as np
+from numba import njit
 
 class PolicyCartpole(nn.Module):
     
@@ -27,6 +33,24 @@ class PolicyCartpole(nn.Module):
         self.fc = nn.Linear(state_space_dimension, num_neurons, bias=bias)
         self.fc1 = nn.Linear(num_neurons, action_space_dimension, bias=bias)
 
+    @torch.inference_mode()
+    def act_batch(self, states: np.ndarray) -> np.ndarray:
+        """
+        Batched forward pass through the network.
+
+        Parameters
+        ----------
+        states : np.ndarray
+            State feature vectors, shape (n, d) or (d,).
+        Returns
+        -------
+        np.ndarray
+            Actions to be taken (0 or 1), shape (n,).
+        """
+        x = torch.from_numpy(np.atleast_2d(np.ascontiguousarray(states, dtype=np.float32)))
+        output = self.fc1(self.fc(x).tanh_())
+        return (output[:, 0] > 0).to(torch.int64).numpy()
+
     def forward(self, x: np.ndarray) -> int:
         """
         Forward pass through the network.
@@ -40,12 +64,66 @@ class PolicyCartpole(nn.Module):
         int
             Action to be taken (0 or 1).
         """
-        x = torch.Tensor( x.reshape((1, self.state_space_dimension)) )
-        hidden = torch.tanh(self.fc(x))
-        output = self.fc1(hidden)
-        return int(output>0)
+        return int(self.act_batch(x)[0])
     
-def fitness_cart_pole(x: np.ndarray, nn: torch.nn.Module, env: Env, mask: list[int]|None = None) -> float:
+def parameter_views(nn: torch.nn.Module) -> list[tuple[torch.nn.Parameter, int, int]]:
+    """
+    Cache the position of every parameter of nn in a flat parameter vector
+    (same order as torch.nn.utils.vector_to_parameters).
+
+    Parameters
+    ----------
+    nn : torch.nn.Module
+
+    Returns
+    -------
+    list[tuple[torch.nn.Parameter, int, int]]
+        (parameter, start, end) for each parameter of nn.
+    """
+    views, start = [], 0
+    for param in nn.parameters():
+        views.append((param, start, start + param.numel()))
+        start += param.numel()
+    return views
+
+def set_parameters(x: np.ndarray, views: list[tuple[torch.nn.Parameter, int, int]]) -> None:
+    """
+    Copy the flat parameter vector x in place into the parameters cached by 'parameter_views'.
+    A float32 x is used without conversion (callers convert a whole generation at once).
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Parameter vector encoding the weights.
+    views : list[tuple[torch.nn.Parameter, int, int]]
+    """
+    flat = torch.from_numpy(np.asarray(x, dtype=np.float32))
+    with torch.no_grad():
+        for param, start, end in views:
+            param.copy_(flat[start:end].view_as(param))
+
+def is_standard_cartpole(env: Env, nn: torch.nn.Module) -> bool:
+    """
+    Whether episodes of nn in env can be simulated by 'cartpole_rollout', i.e. nn is a
+    'PolicyCartpole' and env is an unmodified, time limited CartPole environment (no additional
+    wrappers changing observations or rewards, no Sutton and Barto reward).
+
+    Parameters
+    ----------
+    env : Env
+    nn : torch.nn.Module
+
+    Returns
+    -------
+    bool
+    """
+    return (isinstance(nn, PolicyCartpole) and isinstance(env.unwrapped, CartPoleEnv)
+            and env.spec is not None and env.spec.max_episode_steps is not None
+            and not env.spec.additional_wrappers
+            and not getattr(env.unwrapped, '_sutton_barto_reward', False))
+
+def fitness_cart_pole(x: np.ndarray, nn: torch.nn.Module, env: Env|EnvSpec, mask: list[int]|None = None,
+                      views: list[tuple[torch.nn.Parameter, int, int]]|None = None) -> float:
     """
     Returns negative accumulated reward for single pole, fully environment.
 
@@ -55,12 +133,35 @@ def fitness_cart_pole(x: np.ndarray, nn: torch.nn.Module, env: Env, mask: list[i
         Parameter vector encoding the weights.
     nn : torch.nn.Module 
         Parameterized model.
-    env : Env
-        Environment ('CartPole-v?').
+    env : Env|EnvSpec
+        Environment ('CartPole-v?'). If an EnvSpec is given, the environment is
+        made (and closed) inside the call, which keeps the arguments picklable for worker processes.
     mask : list|None, optional
+    views : list|None, optional
+        Parameter views of nn from 'parameter_views', computed from nn if not given.
     """
-    torch.nn.utils.vector_to_parameters(torch.Tensor(x), nn.parameters())  # Set the policy parameters
+    if not isinstance(env, Env):
+        with make(env) as env:
+            return fitness_cart_pole(x, nn, env, mask, views)
+
+    set_parameters(x, views if views is not None else parameter_views(nn))  # Set the policy parameters
     state = env.reset()[0]  # Forget about previous episode
+
+    if is_standard_cartpole(env, nn):
+        # Standard CartPole, simulate the whole episode without torch or gym
+        with torch.no_grad():
+            W1, W2 = nn.fc.weight.numpy(), nn.fc1.weight.numpy()
+            b1 = nn.fc.bias.numpy() if nn.fc.bias is not None else np.zeros(W1.shape[0], dtype=np.float32)
+            b2 = nn.fc1.bias.numpy() if nn.fc1.bias is not None else np.zeros(W2.shape[0], dtype=np.float32)
+        cartpole = env.unwrapped
+        physics = np.array([cartpole.gravity, cartpole.masscart, cartpole.masspole, cartpole.length,
+                            cartpole.force_mag, cartpole.tau, cartpole.x_threshold,
+                            cartpole.theta_threshold_radians])
+        features = np.flatnonzero(mask) if mask is not None else np.arange(len(state))
+        return cartpole_rollout(np.array(cartpole.state, dtype=np.float64), features, W1, b1, W2, b2,
+                                physics, cartpole.kinematics_integrator == "euler",
+                                env.spec.max_episode_steps)
+
     if mask is not None:
         mask = np.array(mask).astype(bool)
         state = state[mask]  # Convert mask to numpy array
@@ -78,7 +179,173 @@ def fitness_cart_pole(x: np.ndarray, nn: torch.nn.Module, env: Env, mask: list[i
             return -R  # Episode ended, we consider minimization
     return -R  # Never reached  
 
-def train_cartpole_agent(policy_net , env, ftarget=-9999.9, mask=None):  
+@njit(cache=True)
+def cartpole_rollout(state: np.ndarray, features: np.ndarray,
+                     W1: np.ndarray, b1: np.ndarray, W2: np.ndarray, b2: np.ndarray,
+                     physics: np.ndarray, euler: bool, max_episode_steps: int) -> float:
+    """
+    Numba compiled version of 'fitness_cart_pole' for the standard CartPole environment.
+    Both the 'PolicyCartpole' forward pass and the CartPole dynamics (as in gymnasium's CartPoleEnv)
+    are computed inside the compiled loop.
+
+    Parameters
+    ----------
+    state : np.ndarray
+        Initial (float64) state of the environment after reset.
+    features : np.ndarray
+        Indices of the state features observed by the policy.
+    W1, b1, W2, b2 : np.ndarray
+        Weights and biases of the hidden and output layer of the policy.
+    physics : np.ndarray
+        gravity, masscart, masspole, length, force_mag, tau, x_threshold and
+        theta_threshold_radians of the environment.
+    euler : bool
+        Whether the kinematics integrator is 'euler' (otherwise semi-implicit euler).
+    max_episode_steps : int
+        Number of steps before the episode is truncated.
+
+    Returns
+    -------
+    float
+        Negative accumulated reward, -1000 if the episode is truncated.
+    """
+    gravity, masscart, masspole, length, force_mag, tau, x_threshold, theta_threshold = physics
+    total_mass = masspole + masscart
+    polemass_length = masspole * length
+    x, x_dot, theta, theta_dot = state[0], state[1], state[2], state[3]
+    full_state = np.empty(4)
+    obs = np.empty(len(features), dtype=np.float32)
+    hidden = np.empty(W1.shape[0], dtype=np.float32)
+
+    R = 0.0  # Accumulated reward
+    for t in range(max_episode_steps):
+        # Policy forward pass on the (float32) observation
+        full_state[0], full_state[1], full_state[2], full_state[3] = x, x_dot, theta, theta_dot
+        for i in range(len(features)):
+            obs[i] = np.float32(full_state[features[i]])
+        for j in range(W1.shape[0]):
+            acc = b1[j]
+            for i in range(len(features)):
+                acc += W1[j, i] * obs[i]
+            hidden[j] = np.tanh(acc)
+        output = b2[0]
+        for j in range(W1.shape[0]):
+            output += W2[0, j] * hidden[j]
+        force = force_mag if output > 0 else -force_mag
+
+        # Simulate pole
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        temp = (force + polemass_length * theta_dot ** 2 * sintheta) / total_mass
+        thetaacc = (gravity * sintheta - costheta * temp) / (
+            length * (4.0 / 3.0 - masspole * costheta ** 2 / total_mass))
+        xacc = temp - polemass_length * thetaacc * costheta / total_mass
+        if euler:
+            x = x + tau * x_dot
+            x_dot = x_dot + tau * xacc
+            theta = theta + tau * theta_dot
+            theta_dot = theta_dot + tau * thetaacc
+        else:
+            x_dot = x_dot + tau * xacc
+            x = x + tau * x_dot
+            theta_dot = theta_dot + tau * thetaacc
+            theta = theta + tau * theta_dot
+
+        R += 1.0  # Accumulate
+        if t + 1 >= max_episode_steps:
+            return -1000.0  # Episode ended, final goal reached, we consider minimization
+        if x < -x_threshold or x > x_threshold or theta < -theta_threshold or theta > theta_threshold:
+            return -R  # Episode ended, we consider minimization
+    return -R
+
+@torch.jit.script
+def population_forward(states: torch.Tensor, fc_weight: torch.Tensor, fc1_weight: torch.Tensor,
+                       fc_bias: Optional[torch.Tensor] = None,
+                       fc1_bias: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    TorchScript compiled forward pass of 'PolicyCartpole', where every state has its own weights.
+
+    Parameters
+    ----------
+    states : torch.Tensor
+        State feature vectors, shape (p, d).
+    fc_weight : torch.Tensor
+        Hidden layer weights, shape (p, num_neurons, d).
+    fc1_weight : torch.Tensor
+        Output layer weights, shape (p, action_space_dimension, num_neurons).
+    fc_bias, fc1_bias : torch.Tensor|None, optional
+        Biases of shape (p, num_neurons) and (p, action_space_dimension).
+    Returns
+    -------
+    torch.Tensor
+        Actions to be taken (0 or 1), shape (p,).
+    """
+    hidden = torch.bmm(fc_weight, states.unsqueeze(2)).squeeze(2)
+    if fc_bias is not None:
+        hidden = hidden + fc_bias
+    output = torch.bmm(fc1_weight, hidden.tanh_().unsqueeze(2)).squeeze(2)
+    if fc1_bias is not None:
+        output = output + fc1_bias
+    return (output[:, 0] > 0).to(torch.int64)
+
+def population_fitness_cart_pole(X: list[np.ndarray], nn: torch.nn.Module, envs: VectorEnv,
+                                 mask: list[int]|None = None) -> np.ndarray:
+    """
+    Vectorized version of 'fitness_cart_pole', evaluating a whole CMA-ES population at once.
+    Candidate i is rolled out in sub-environment i, and all candidates share a single
+    batched forward pass per environment step.
+
+    Parameters
+    ----------
+    X : list[np.ndarray]
+        Population of parameter vectors, as returned by 'CMAEvolutionStrategy.ask'.
+    nn : torch.nn.Module
+        Parameterized model, only used for its parameter layout.
+    envs : VectorEnv
+        Vectorized environment ('CartPole-v?') with one sub-environment per candidate.
+    mask : list|None, optional
+
+    Returns
+    -------
+    np.ndarray
+        Negative accumulated reward for each candidate.
+    """
+    population_size = len(X)
+    X = torch.as_tensor(np.asarray(X), dtype=torch.float32)
+
+    # Split every candidate vector into the parameter shapes of nn (same order as vector_to_parameters)
+    W, start = {}, 0
+    for name, param in nn.named_parameters():
+        end = start + param.numel()
+        W[name] = X[:, start:end].view(population_size, *param.shape)
+        start = end
+
+    if mask is not None:
+        mask = np.array(mask).astype(bool)
+    states = envs.reset()[0]  # Forget about previous episodes
+    if mask is not None:
+        states = states[:, mask]
+
+    R = np.zeros(population_size)  # Accumulated rewards
+    alive = np.ones(population_size, dtype=bool)  # Candidates whose episode has not ended
+    reached_goal = np.zeros(population_size, dtype=bool)
+    with torch.no_grad():
+        while alive.any():
+            s = torch.from_numpy(np.asarray(states, dtype=np.float32))
+            actions = population_forward(s, W['fc.weight'], W['fc1.weight'],
+                                         W.get('fc.bias'), W.get('fc1.bias')).numpy()
+
+            states, rewards, terminated, truncated, _ = envs.step(actions)  # Simulate poles
+            if mask is not None:
+                states = states[:, mask]
+            R += rewards * alive  # Finished sub-environments are auto-reset, ignore their rewards
+            reached_goal |= alive & truncated
+            alive &= ~(terminated | truncated)
+
+    R[reached_goal] = 1000  # Episode ended, final goal reached
+    return -R  # We consider minimization
+
+def train_cartpole_agent(policy_net , env, ftarget=-9999.9, mask=None, num_processes=None):  
     """
     Function to train a policy network for the CartPole environment using CMA-ES.   
     
@@ -90,6 +357,12 @@ def train_cartpole_agent(policy_net , env, ftarget=-9999.9, mask=None):
         CartPole environment.
     ftarget : float
         Target fitness value for CMA-ES. Default is -9999.9.
+    mask : list|None, optional
+    num_processes : int|None, optional
+        If given, candidates are evaluated with 'fitness_cart_pole' in a pool of this many
+        worker processes. Otherwise, candidates are evaluated one after another with
+        'fitness_cart_pole' (Numba compiled rollout) for a standard CartPole environment,
+        and in a single vectorized environment for any other environment. Default is None.
     Returns
     -------
     policy_net : PolicyCartpole
@@ -103,18 +376,33 @@ def train_cartpole_agent(policy_net , env, ftarget=-9999.9, mask=None):
     initial_weights = np.random.normal(0, 0.01, d)  # Random parameters for initial policy, d denotes the number of weights
     initial_sigma = .01 # Initial global step-size sigma
 
+    views = parameter_views(policy_net)
+
     # Do the optimization
-    cma_options = {'ftarget': ftarget, 'tolflatfitness':1000, 'eval_final_mean':False,
+    cma_options = {'ftarget': ftarget, 'tolflatfitness':1000,
                    'verb_filenameprefix': '', 'verb_log': 0, 'verb_disp': 0}
-    res = cma.fmin(fitness_cart_pole,  # Objective function
-                initial_weights,  # Initial search point
-                initial_sigma,  # Initial global step-size sigma
-                args=([policy_net, env, mask]),  # Arguments passed to the fitness function
-                   options=cma_options)
+    es = cma.CMAEvolutionStrategy(initial_weights, initial_sigma, cma_options)
+    if num_processes is not None:
+        with cma.optimization_tools.EvalParallel2(fitness_cart_pole, number_of_processes=num_processes) as eval_all:
+            while not es.stop():
+                X = es.ask()
+                X32 = np.asarray(X, dtype=np.float32)  # Convert the generation once, rows are used as is
+                es.tell(X, eval_all(X32, args=(policy_net, env.spec, mask, views)))
+    elif is_standard_cartpole(env, policy_net):
+        while not es.stop():
+            X = es.ask()
+            X32 = np.asarray(X, dtype=np.float32)  # Convert the generation once, rows are used as is
+            es.tell(X, [fitness_cart_pole(x, policy_net, env, mask, views) for x in X32])
+    else:
+        envs = SyncVectorEnv([lambda: make(env.spec)] * es.popsize)  # One environment per candidate
+        while not es.stop():
+            X = es.ask()
+            es.tell(X, population_fitness_cart_pole(X, policy_net, envs, mask).tolist())
+        envs.close()
     env.close()
-  
+
     # Set the policy parameters to the final solution
-    torch.nn.utils.vector_to_parameters(torch.Tensor(res[0]), policy_net.parameters())      
+    set_parameters(es.result.xbest, views)
 
     return policy_net  # Return the policy network
 
@@ -1,34 +1,47 @@
 import numpy as np
-from itertools import product
+
+def _binary_table(num_bits: int) -> np.ndarray:
+    """
+    All 2**num_bits binary numbers as rows of bits, most significant bit first.
+
+    Parameters
+    ----------
+    num_bits : int
+        At most 32.
+
+    Returns
+    -------
+    table : np.ndarray
+        int64 array of shape (2**num_bits, num_bits).
+    """
+    nums = np.arange(2 ** num_bits, dtype='>u4').view(np.uint8).reshape(-1, 4)  # big-endian bytes
+    return np.unpackbits(nums, axis=1)[:, 32 - num_bits:].astype(np.int64)
 
 #gets all subsets of masks when one feature is fixed to 0.
 #basically all c \in f/i 
 
-def get_limited_subsets(fixed_features: list[int], num_features: int) -> list[int]:
+def get_limited_subsets(fixed_features: list[int], num_features: int) -> np.ndarray:
     """
-    Generate a list of all mask permutations excluding feature group i.
+    Generate all mask permutations excluding feature group i.
 
     Parameters
     ----------
     fixed_features : list
     num_features : int
-    """
-    coalitions = []
 
+    Returns
+    -------
+    coalitions : np.ndarray
+        int64 array of shape (2**(num_features - len(fixed_features)), num_features).
+    """
     # Index of every feature not in the list of 'fixed_features'
     other_features = [idx for idx in range(num_features) if idx not in fixed_features] 
-    num_of = len(other_features) # Number of other features
 
-    for i in range(2 ** num_of):
-        binary = [0] * num_features
-        for bit_pos in range(num_of):
-            original_pos = other_features[bit_pos]
-            bit_value = (i >> (num_of - 1 - bit_pos)) & 1
-            binary[original_pos] = bit_value
-        coalitions.append(binary)
+    coalitions = np.zeros((2 ** len(other_features), num_features), dtype=np.int64)
+    coalitions[:, other_features] = _binary_table(len(other_features))
     return coalitions
 
-def get_all_subsets(state_space_dim: int) -> list[list[int]]:
+def get_all_subsets(state_space_dim: int) -> np.ndarray:
     """
     Generate all permutations of binary lists of length 'state_space_dim'
     
@@ -38,10 +51,11 @@ def get_all_subsets(state_space_dim: int) -> list[list[int]]:
         
     Returns
     -------
-    variations : list[list[int]]
-        list of permutations as lists of integers (0 or 1).
+    variations : np.ndarray
+        int64 array of shape (2**state_space_dim, state_space_dim),
+        one permutation (0 or 1 entries) per row.
     """
-    return [list(mask) for mask in product([0, 1], repeat=state_space_dim)]
+    return _binary_table(state_space_dim)
 
 def get_all_group_subsets(G: list) -> np.ndarray:
     """
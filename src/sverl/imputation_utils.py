@@ -46,7 +46,8 @@ class StateFeatureDataset(Dataset):
 
 def get_trajectory(policy: callable,
                    env: Env,
-                   time_horizon: int = 10**3) -> np.ndarray: 
+                   time_horizon: int = 10**3,
+                   verbose: bool = True) -> np.ndarray: 
     """
     Get a trajectory of the agent, given a policy and an environment. 
     
@@ -58,26 +59,33 @@ def get_trajectory(policy: callable,
         the environment to generate trajectories from
     time_horizon: int
         the time horizon to generate trajectories for, default is 10**3
+    verbose: bool
+        whether to show a progress bar, default is True
     
     Returns
     -------
     trajectory_features: numpy.ndarray
         the trajectory features, shape (t, d), where t is the time horizon and d is the state space dimension
     """
-    trajectory_features = []  # store the features of the trajectory
-    state = env.reset()[0]  # forget about previous episode, and sample s_0 ~ p_0 
+    # Cache environment reset and step methods
+    reset_fn = env.reset
+    step_fn = env.step
+
+    # store the features of the trajectory
+    trajectory_features = np.empty((time_horizon, env.observation_space.shape[0]), dtype=np.float32) # type: ignore
+    state = reset_fn()[0]  # forget about previous episode, and sample s_0 ~ p_0 
     
-    for _ in trange(time_horizon):     
+    for t in (trange(time_horizon) if verbose else range(time_horizon)):     
 
         a = policy(state)
         
-        state, _ , terminated, truncated, _ = env.step(a)
+        state, _ , terminated, truncated, _ = step_fn(a)
         if(terminated or truncated): 
-            state = env.reset()[0]
+            state = reset_fn()[0]
             
-        trajectory_features.append(state)          
+        trajectory_features[t] = state          
         
-    return np.array(trajectory_features)
+    return trajectory_features
 
 def save_trajectory(trajectories: np.ndarray,
                     filename: str,
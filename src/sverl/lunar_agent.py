@@ -1,8 +1,12 @@
+import math
+import random
+import sys
+
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from collections import deque
-from tqdm import trange
+from gymnasium import make
+from gymnasium.vector import AsyncVectorEnv
+from tqdm import tqdm, trange
 
 import numpy as np
 
@@ -29,7 +33,16 @@ class QNetwork(nn.Module):
         self.bias = bias
         self.fc1 = nn.Linear(state_size, hidden_size, bias)  
         self.fc2 = nn.Linear(hidden_size, hidden_size, bias)  
-        self.output_layer = nn.Linear(hidden_size + state_size, action_size, bias)
+        # Output layer on the concatenation (x_input, hidden), split in two to avoid the concatenation.
+        # Initialised as a single layer (fan-in hidden_size + state_size) and copied into the two halves.
+        output_layer = nn.Linear(hidden_size + state_size, action_size, bias)
+        self.output_state = nn.utils.skip_init(nn.Linear, state_size, action_size, bias=False)
+        self.output_hidden = nn.utils.skip_init(nn.Linear, hidden_size, action_size, bias)
+        with torch.no_grad():
+            self.output_state.weight.copy_(output_layer.weight[:, :state_size])
+            self.output_hidden.weight.copy_(output_layer.weight[:, state_size:])
+            if bias:
+                self.output_hidden.bias.copy_(output_layer.bias)
 
     def forward(self, x_input):
         """
@@ -44,10 +57,9 @@ class QNetwork(nn.Module):
             torch.Tensor: 
                 Q-values for each action.
         """
-        x = F.tanh(self.fc1(x_input))
-        x = F.tanh(self.fc2(x))
-        x = torch.cat((x_input, x), dim=1)
-        x = self.output_layer(x)
+        x = self.fc1(x_input).tanh_()  # in place, the linear output is a fresh tensor
+        x = self.fc2(x).tanh_()
+        x = self.output_hidden(x) + self.output_state(x_input)
         return x
     
     def predict(self, x_input): 
@@ -67,35 +79,80 @@ class QNetwork(nn.Module):
         if torch.cuda.is_available():
             x_input = x_input.cuda()
         with torch.no_grad():
-            x = F.tanh(self.fc1(x_input))
-            x = F.tanh(self.fc2(x))
-            x = torch.cat((x_input, x), dim=1)
-            x = self.output_layer(x)
+            x = self.fc1(x_input).tanh_()
+            x = self.fc2(x).tanh_()
+            x = self.output_hidden(x) + self.output_state(x_input)
             x = torch.argmax(x).item()
         return x
 
 class Memory():
-    def __init__(self, max_size = 1000):
+    def __init__(self, max_size = 1000, state_size = 8):
         """
         Experience replay memory for storing past experiences.
+        Stored as a circular buffer of preallocated tensors, one per experience field.
         
         Parameters
         -------------
             max_size : int 
                 Maximum size of the memory buffer.
+            state_size : int
+                Size of the state space.
         """
-        self.buffer = deque(maxlen=max_size)
+        self.max_size = max_size
+        self.states = torch.empty((max_size, state_size), dtype=torch.float32)
+        self.actions = torch.empty(max_size, dtype=torch.int64)
+        self.rewards = torch.empty(max_size, dtype=torch.float32)
+        self.next_states = torch.empty((max_size, state_size), dtype=torch.float32)
+        self.dones = torch.empty(max_size, dtype=torch.bool)
+        self.pos = 0
+        self.full = False
+
+    def __len__(self):
+        return self.max_size if self.full else self.pos
     
-    def add(self, experience):
+    def add(self, state, action, reward, next_state, done):
         """
-        Add an experience to the memory buffer.
+        Add an experience to the memory buffer, overwriting the oldest one when full.
         
         Parameters
         -------------
-            experience : tuple 
-                Experience tuple (state, action, reward, next_state).
+            state : numpy.ndarray
+            action : int
+            reward : float
+            next_state : numpy.ndarray
+            done : bool
+                Whether the episode ended after this experience.
         """
-        self.buffer.append(experience)
+        self.states[self.pos] = torch.from_numpy(np.asarray(state, dtype=np.float32))
+        self.actions[self.pos] = int(action)
+        self.rewards[self.pos] = float(reward)
+        self.next_states[self.pos] = torch.from_numpy(np.asarray(next_state, dtype=np.float32))
+        self.dones[self.pos] = bool(done)
+        self.pos = (self.pos + 1) % self.max_size
+        self.full = self.full or self.pos == 0
+            
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """
+        Add a batch of experiences to the memory buffer, overwriting the oldest ones when full.
+        
+        Parameters
+        -------------
+            states : numpy.ndarray
+            actions : numpy.ndarray
+            rewards : numpy.ndarray
+            next_states : numpy.ndarray
+            dones : numpy.ndarray
+                Whether the episode ended after each experience.
+        """
+        n = len(actions)
+        idx = (self.pos + torch.arange(n)) % self.max_size
+        self.states[idx] = torch.as_tensor(states, dtype=torch.float32)
+        self.actions[idx] = torch.as_tensor(actions, dtype=torch.int64)
+        self.rewards[idx] = torch.as_tensor(rewards, dtype=torch.float32)
+        self.next_states[idx] = torch.as_tensor(next_states, dtype=torch.float32)
+        self.dones[idx] = torch.as_tensor(dones, dtype=torch.bool)
+        self.full = self.full or self.pos + n >= self.max_size
+        self.pos = (self.pos + n) % self.max_size
             
     def sample(self, batch_size):
         """
@@ -107,12 +164,11 @@ class Memory():
                 Number of experiences to sample.
         Returns
         -------------
-            list:
-                List of sampled experiences."""
-        idx = np.random.choice(np.arange(len(self.buffer)), 
-                               size=batch_size, 
-                               replace=False)
-        return [self.buffer[ii] for ii in idx]
+            tuple:
+                Tensors (states, actions, rewards, next_states, dones) of the sampled experiences."""
+        idx = torch.randint(0, len(self), (batch_size,))
+        return (self.states[idx], self.actions[idx], self.rewards[idx],
+                self.next_states[idx], self.dones[idx])
     
 
 def train_Qnetwork(mainQN, 
@@ -125,7 +181,11 @@ def train_Qnetwork(mainQN,
                    explore_stop = 0.0001, 
                    decay_rate = 0.05, 
                    memory_size = 10000, 
-                   batch_size = 128):
+                   batch_size = 128,
+                   target_update_every = 1,
+                   num_envs = 1,
+                   bf16_actions = False,
+                   compile_network = True):
     """
     Train a Q-learning agent using experience replay and delayed target network soft updates.
     
@@ -153,6 +213,18 @@ def train_Qnetwork(mainQN,
         Maximum size of the experience replay memory.
     batch_size : int
         Size of the mini-batch for training.
+    target_update_every : int
+        Number of gradient steps between soft updates of the target network.
+    num_envs : int
+        Number of environments collecting experiences in parallel. If larger than 1,
+        copies of env are stepped in an AsyncVectorEnv, adding num_envs experiences
+        to memory per gradient step.
+    bf16_actions : bool
+        Whether to run the Q-network in bfloat16 autocast when selecting actions.
+        Training is always done in float32. Only faster on hardware with native bfloat16 support.
+    compile_network : bool
+        Whether to torch.compile the online Q-network (ignored on macOS). Disable on machines
+        without a working C++ toolchain, where compilation fails.
     
     Returns
     -------------
@@ -169,108 +241,140 @@ def train_Qnetwork(mainQN,
     # Move networks to device
     mainQN = mainQN.to(device)
     targetQN = targetQN.to(device)
+
+    # Compile the online network to fuse its small forward pass, torch.compile is unreliable on macOS
+    if compile_network and sys.platform != "darwin":
+        mainQN = torch.compile(mainQN, mode="reduce-overhead")
     
     state = env.reset()[0]
-    action_size = env.action_space.n
     state_size = env.observation_space.shape[0]
-    memory = Memory(max_size=memory_size)
+    memory = Memory(max_size=memory_size, state_size=state_size)
+    action_sample = env.action_space.sample
 
     # Make a bunch of random actions and store the experiences
     for _ in range(pretrain_length):
         # Make a random action
-        action = env.action_space.sample()
+        action = action_sample()
         next_state, reward, terminated, truncated, _ = env.step(action)
+        done = terminated or truncated
 
-        if terminated or truncated:
-            # The simulation fails, so no next state
-            next_state = np.zeros(state.shape)
-            # Add experience to memory
-            memory.add((state, action, reward, next_state))
-            
+        # Add experience to memory
+        memory.add(state, action, reward, next_state, done)
+
+        if done:
             # Start new episode
             env.reset()
             # Take one random step to get the pole and cart moving
-            state, reward, terminated, truncated, _ = env.step(env.action_space.sample())
+            state, reward, terminated, truncated, _ = env.step(action_sample())
         else:
-            # Add experience to memory
-            memory.add((state, action, reward, next_state))
             state = next_state
 
     optimizer = torch.optim.AdamW(mainQN.parameters(), lr=learning_rate)
     loss_fn = torch.nn.MSELoss()
+    main_params = list(mainQN.parameters())
+    target_params = list(targetQN.parameters())
+    step = 0  # Number of gradient steps
 
-    for ep in trange(train_episodes):
-        total_reward = 0  # Return / accumulated rewards
-        state = env.reset()[0]  # Reset and get initial state
-        while True:
-            # Explore or exploit
-            explore_p = explore_stop + (explore_start - explore_stop)*np.exp(-decay_rate*ep) 
-            if explore_p > np.random.rand():
-                # Pick a random action
-                action = env.action_space.sample()
-            else:
-                # Get action from Q-network
-                state_tensor = torch.from_numpy(np.resize(state, (1, state_size)).astype(np.float32)).to(device)
-                with torch.no_grad():
-                    Qs = mainQN(state_tensor)
-                action = torch.argmax(Qs).item()
+    def learn():
+        """One gradient step on a mini-batch from memory, followed by the target network update."""
+        nonlocal step
+
+        # Sample mini-batch from memory
+        states, actions, rewards, next_states, dones = memory.sample(batch_size)
+        states = states.to(device)
+        actions = actions.to(device)
+        rewards = rewards.to(device)
+        next_states = next_states.to(device)
+        dones = dones.to(device)
+            
+        # Compute targets from the Q values for all actions in the new state.
+        # These come from the frozen (soft updated) targetQN, so they cannot share
+        # a concatenated forward pass with mainQN(states) below.
+        with torch.no_grad():
+            target_Qs = targetQN(next_states)
+            target_Qs[dones] = 0  # No future rewards where the episode ended
+            y = rewards + gamma * target_Qs.max(1).values
 
-            # Take action, get new state and reward
-            next_state, reward, terminated, truncated, _ = env.step(action)
+        # Network learning starts here
+        optimizer.zero_grad()
         
-            total_reward += reward  # Return / accumulated rewards
+        # Compute the Q values of the actions taken        
+        main_Qs = mainQN(states)  # Q values for all action in each state
+        Q = torch.gather(main_Qs, 1, actions.unsqueeze(-1)).squeeze()  # Only the Q values for the actions taken
+        
+        # Gradient-based update
+        loss = loss_fn(Q, y)
+        loss.backward()
+        optimizer.step()
+
+        # Soft update target network
+        step += 1
+        if step % target_update_every == 0:
+            with torch.no_grad():
+                torch._foreach_mul_(target_params, 1 - tau)
+                torch._foreach_add_(target_params, main_params, alpha=tau)
+
+    if num_envs == 1:
+        state_buf = torch.empty((1, state_size), dtype=torch.float32, device=device)  # Reused Q-network input
+
+        for ep in trange(train_episodes):
+            total_reward = 0  # Return / accumulated rewards
+            state = env.reset()[0]  # Reset and get initial state
+            explore_p = explore_stop + (explore_start - explore_stop)*math.exp(-decay_rate*ep) 
+            while True:
+                # Explore or exploit
+                if explore_p > random.random():
+                    # Pick a random action
+                    action = action_sample()
+                else:
+                    # Get action from Q-network
+                    state_buf[0] = torch.from_numpy(state)
+                    with torch.inference_mode(), torch.autocast(device.type, torch.bfloat16, enabled=bf16_actions):
+                        action = int(mainQN(state_buf).argmax(1).item())
+
+                # Take action, get new state and reward
+                next_state, reward, terminated, truncated, _ = env.step(action)
             
-            if terminated or truncated:
-                # Episode ends because of failure, so no next state
-                next_state = np.zeros(state.shape)
-                    
-                # Add experience to memory
-                memory.add((state, action, reward, next_state))
-                break; # End of episode
-            else:
+                total_reward += reward  # Return / accumulated rewards
+                done = terminated or truncated
+
                 # Add experience to memory
-                memory.add((state, action, reward, next_state))
+                memory.add(state, action, reward, next_state, done)
+                if done:
+                    break; # End of episode
                 state = next_state
-                
-            # Sample mini-batch from memory
-            batch = memory.sample(batch_size)
-            next_states_np = np.array([each[3] for each in batch], dtype=np.float32)
-            next_states = torch.as_tensor(next_states_np).to(device)
-            rewards = torch.as_tensor(np.array([each[2] for each in batch], dtype=np.float32)).to(device)
-            states = torch.as_tensor(np.array([each[0] for each in batch], dtype=np.float32)).to(device)
-            actions = torch.as_tensor(np.array([each[1] for each in batch], dtype=np.int64)).to(device)
-                
-            # Compute Q values for all actions in the new state       
-            with torch.no_grad():
-                target_Qs = targetQN(next_states)
-                
-            # Set target_Qs to 0 for states where episode ended because of failure
-            episode_ends = (next_states_np == np.zeros(states[0].shape)).all(axis=1)
-            target_Qs[episode_ends] = torch.zeros(action_size, device=device)            
-            
-            # Compute targets
-            with torch.no_grad():
-                y = rewards + gamma * torch.max(target_Qs, dim=1).values       
 
-            # Network learning starts here
-            optimizer.zero_grad()
-            
-            # Compute the Q values of the actions taken        
-            main_Qs = mainQN(states)  # Q values for all action in each state
-            Q = torch.gather(main_Qs, 1, actions.unsqueeze(-1)).squeeze()  # Only the Q values for the actions taken
-            
-            # Gradient-based update
-            loss = loss_fn(Q, y)
-            loss.backward()
-            optimizer.step()
+                learn()
+    else:
+        # Collect one transition per sub-environment and gradient step
+        envs = AsyncVectorEnv([lambda: make(env.spec)] * num_envs)
+        states = envs.reset()[0]
+        autoreset = np.zeros(num_envs, dtype=bool)  # Sub-environments that are reset by the next step
+        finished_episodes = 0
+
+        with tqdm(total=train_episodes) as progress:
+            while finished_episodes < train_episodes:
+                # Explore or exploit, per sub-environment
+                explore_p = explore_stop + (explore_start - explore_stop)*math.exp(-decay_rate*finished_episodes)
+                with torch.inference_mode(), torch.autocast(device.type, torch.bfloat16, enabled=bf16_actions):
+                    greedy_actions = mainQN(torch.from_numpy(states).to(device)).argmax(1).cpu().numpy()
+                actions = np.where(np.random.rand(num_envs) < explore_p, envs.action_space.sample(), greedy_actions)
+
+                # Take actions, get new states and rewards
+                next_states, rewards, terminated, truncated, _ = envs.step(actions)
+                dones = terminated | truncated
 
-            # Update target network
-            sdTargetQN = targetQN.state_dict()
-            sdMainQN = mainQN.state_dict() 
+                # Add experiences to memory, a step that resets a sub-environment is not an experience
+                valid = ~autoreset
+                memory.add_batch(states[valid], actions[valid], rewards[valid], next_states[valid], dones[valid])
+                autoreset = dones
+                states = next_states
 
-            for key in sdTargetQN:
-                sdTargetQN[key] = tau * sdMainQN[key] + (1 - tau) * sdTargetQN[key]
+                num_finished = min(int(dones.sum()), train_episodes - finished_episodes)
+                finished_episodes += num_finished
+                progress.update(num_finished)
 
-            targetQN.load_state_dict(sdTargetQN)
+                learn()
+        envs.close()
 
     return targetQN.predict
@@ -58,7 +58,7 @@ def shapley_value(i: int, characteristic_dict: dict) -> float:
         Shapley value for the feature.
     """
     F = int(log2(len(characteristic_dict)))  # Number of features
-    list_of_C = np.array(get_limited_subsets([i], F), dtype=int)
+    list_of_C = get_limited_subsets([i], F)
     sum = 0
     for C in list_of_C:
         cardinality = np.sum(C)  # Cardinality of the coalition
@@ -108,7 +108,7 @@ def get_rt_characteristic_dict(savepath: str, env: Env, policy_class: callable,
     action_space_dim = env.action_space.n - 1
     state_space_dim = env.observation_space.shape[0]
     all_coalitions = get_all_group_subsets(G) if G else get_all_subsets(state_space_dim)
-    models_by_coalitions = np.array(num_models * all_coalitions) 
+    models_by_coalitions = np.tile(all_coalitions, (num_models, 1))
 
     def process_task(mask):
         """Process a single (coalition, model) training/evaluation task"""
@@ -1,11 +1,10 @@
 import math
 
-import numpy as np
 import torch
-from torch.distributions import kl_divergence
+from torch.distributions import Normal
 from torch.nn import Module
 
-from .prob_utils import normal_parse_params
+from .prob_utils import normal_kl, normal_log_prob, normal_parse_mu_sigma, normal_parse_params
 
 
 class VAEAC(Module):
@@ -67,15 +66,17 @@ class VAEAC(Module):
     def make_observed(self, batch, mask):
         """
         Copy batch of objects and zero unobserved features.
+        If every feature is observed, the batch is returned without a copy.
         """
-        observed = batch.detach().clone()
-        observed[mask.bool()] = 0
-        return observed
+        if not mask.any():
+            return batch.detach()
+        return batch.detach().masked_fill(mask.bool(), 0)
 
-    def make_latent_distributions(self, batch, mask, no_proposal=False):
+    def make_latent_params(self, batch, mask, no_proposal=False):
         """
-        Make latent distributions for the given batch and mask.
-        No no_proposal is True, return None instead of proposal distribution.
+        Make the means and stds of the latent distributions for the given batch and mask.
+        Returns ((proposal_mu, proposal_sigma), (prior_mu, prior_sigma)).
+        No no_proposal is True, return None instead of proposal parameters.
         """
         observed = self.make_observed(batch, mask)
         if no_proposal:
@@ -83,12 +84,22 @@ class VAEAC(Module):
         else:
             full_info = torch.cat([batch, mask], 1)
             proposal_params = self.proposal_network(full_info)
-            proposal = normal_parse_params(proposal_params, 1e-3)
+            proposal = normal_parse_mu_sigma(proposal_params, 1e-3)
         prior_params = self.prior_network(torch.cat([observed, mask], 1))
-        prior = normal_parse_params(prior_params, 1e-3)
+        prior = normal_parse_mu_sigma(prior_params, 1e-3)
         return proposal, prior
 
-    def prior_regularization(self, prior):
+    def make_latent_distributions(self, batch, mask, no_proposal=False):
+        """
+        Make latent distributions for the given batch and mask.
+        No no_proposal is True, return None instead of proposal distribution.
+        """
+        proposal, prior = self.make_latent_params(batch, mask, no_proposal)
+        if proposal is not None:
+            proposal = Normal(*proposal)
+        return proposal, Normal(*prior)
+
+    def prior_regularization(self, prior_mu, prior_sigma):
         """
         The prior distribution regularization in the latent space.
         Though it saves prior distribution parameters from going to infinity,
@@ -96,9 +107,9 @@ class VAEAC(Module):
         It almost doesn't affect learning process near zero with default
         regularization parameters which are recommended to be used.
         """
-        num_objects = prior.mean.shape[0]
-        mu = prior.mean.view(num_objects, -1)
-        sigma = prior.scale.view(num_objects, -1)
+        num_objects = prior_mu.shape[0]
+        mu = prior_mu.view(num_objects, -1)
+        sigma = prior_sigma.view(num_objects, -1)
         mu_regularizer = -(mu ** 2).sum(-1) / 2 / (self.sigma_mu ** 2)
         sigma_regularizer = (sigma.log() - sigma).sum(-1) * self.sigma_sigma
         return mu_regularizer + sigma_regularizer
@@ -108,44 +119,52 @@ class VAEAC(Module):
         Compute differentiable lower bound for the given batch of objects
         and mask.
         """
-        proposal, prior = self.make_latent_distributions(batch, mask)
-        prior_regularization = self.prior_regularization(prior)
-        latent = proposal.rsample()
+        (proposal_mu, proposal_sigma), (prior_mu, prior_sigma) = self.make_latent_params(batch, mask)
+        prior_regularization = self.prior_regularization(prior_mu, prior_sigma)
+        latent = proposal_mu + proposal_sigma * torch.randn_like(proposal_mu)
         rec_params = self.generative_network(latent)
         rec_loss = self.rec_log_prob(batch, rec_params, mask)
-        kl = kl_divergence(proposal, prior).view(batch.shape[0], -1).sum(-1)
+        kl = normal_kl(proposal_mu, proposal_sigma, prior_mu, prior_sigma)
+        kl = kl.view(batch.shape[0], -1).sum(-1)
         return rec_loss - kl + prior_regularization
 
+    def tile_batch(self, batch, mask, K):
+        """
+        Repeat the batch and the mask K times along the first axis, so that
+        object i of the k-th copy is at index k * n + i, where n is the batch size.
+        The prior network has to be run on the tiled batch as well, because
+        nn_utils.MemoryLayer skip-connections require the prior and generative
+        networks to share the batch size.
+        """
+        return batch.repeat(K, *[1] * (batch.dim() - 1)), mask.repeat(K, *[1] * (mask.dim() - 1))
+
     def batch_iwae(self, batch, mask, K):
         """
         Compute IWAE log likelihood estimate with K samples per object.
         Technically, it is differentiable, but it is recommended to use it
         for evaluation purposes inside torch.no_grad in order to save memory.
-        With torch.no_grad the method almost doesn't require extra memory
-        for very large K.
-        The method makes K independent passes through generator network,
-        so the batch size is the same as for training with batch_vlb.
+        The method makes a single pass through generator network
+        with K samples per object, so it requires K times more memory
+        than training with batch_vlb.
         """
-        proposal, prior = self.make_latent_distributions(batch, mask)
-        estimates = []
-        for i in range(K):
-            latent = proposal.rsample()
-
-            rec_params = self.generative_network(latent)
-            rec_loss = self.rec_log_prob(batch, rec_params, mask)
+        n = batch.shape[0]
+        batch, mask = self.tile_batch(batch, mask, K)
+        (proposal_mu, proposal_sigma), (prior_mu, prior_sigma) = self.make_latent_params(batch, mask)
+        latent = proposal_mu + proposal_sigma * torch.randn_like(proposal_mu)
 
-            prior_log_prob = prior.log_prob(latent)
-            prior_log_prob = prior_log_prob.view(batch.shape[0], -1)
-            prior_log_prob = prior_log_prob.sum(-1)
+        rec_params = self.generative_network(latent)
+        rec_loss = self.rec_log_prob(batch, rec_params, mask)
 
-            proposal_log_prob = proposal.log_prob(latent)
-            proposal_log_prob = proposal_log_prob.view(batch.shape[0], -1)
-            proposal_log_prob = proposal_log_prob.sum(-1)
+        prior_log_prob = normal_log_prob(latent, prior_mu, prior_sigma)
+        prior_log_prob = prior_log_prob.view(batch.shape[0], -1)
+        prior_log_prob = prior_log_prob.sum(-1)
 
-            estimate = rec_loss + prior_log_prob - proposal_log_prob
-            estimates.append(estimate[:, None])
+        proposal_log_prob = normal_log_prob(latent, proposal_mu, proposal_sigma)
+        proposal_log_prob = proposal_log_prob.view(batch.shape[0], -1)
+        proposal_log_prob = proposal_log_prob.sum(-1)
 
-        return torch.logsumexp(torch.cat(estimates, 1), 1) - math.log(K)
+        estimates = (rec_loss + prior_log_prob - proposal_log_prob).view(K, n)
+        return torch.logsumexp(estimates, 0) - math.log(K)
 
     def generate_samples_params(self, batch, mask, K=1):
         """
@@ -157,16 +176,15 @@ class VAEAC(Module):
         if the batch shape is [n x D1 x D2], then the result shape is
         [n x K x D1 x D2].
         It is better to use it inside torch.no_grad in order to save memory.
-        With torch.no_grad the method doesn't require extra memory
-        except the memory for the result.
+        All K samples are generated in a single pass, so the method
+        requires K times more memory than a single sample.
         """
-        _, prior = self.make_latent_distributions(batch, mask)
-        samples_params = []
-        for i in range(K):
-            latent = prior.rsample()
-            sample_params = self.generative_network(latent)
-            samples_params.append(sample_params.unsqueeze(1))
-        return torch.cat(samples_params, 1)
+        n = batch.shape[0]
+        batch, mask = self.tile_batch(batch, mask, K)
+        _, prior = self.make_latent_distributions(batch, mask, no_proposal=True)
+        latent = prior.rsample()
+        samples_params = self.generative_network(latent)
+        return samples_params.view(K, n, *samples_params.shape[1:]).transpose(0, 1)
 
     def generate_reconstructions_params(self, batch, mask, K=1):
         """
@@ -178,16 +196,15 @@ class VAEAC(Module):
         if the batch shape is [n x D1 x D2], then the result shape is
         [n x K x D1 x D2].
         It is better to use it inside torch.no_grad in order to save memory.
-        With torch.no_grad the method doesn't require extra memory
-        except the memory for the result.
+        All K reconstructions are generated in a single pass, so the method
+        requires K times more memory than a single reconstruction.
         """
-        _, prior = self.make_latent_distributions(batch, mask)
-        reconstructions_params = []
-        for i in range(K):
-            latent = prior.rsample()
-            rec_params = self.generative_network(latent)
-            reconstructions_params.append(rec_params.unsqueeze(1))
-        return torch.cat(reconstructions_params, 1)
+        n = batch.shape[0]
+        batch, mask = self.tile_batch(batch, mask, K)
+        _, prior = self.make_latent_distributions(batch, mask, no_proposal=True)
+        latent = prior.rsample()
+        rec_params = self.generative_network(latent)
+        return rec_params.view(K, n, *rec_params.shape[1:]).transpose(0, 1)
 
     def generate_probable_sample(self, state, mask):
         """
@@ -205,31 +222,20 @@ class VAEAC(Module):
         sample : array-like
             Observed features remain, unobserved features sampled on-manifold by VAEAC.
         """
-        mask = [1 - x for x in mask]
-        mask = torch.tensor(mask, device='cpu').float().unsqueeze(0)
-
-        if isinstance(state, np.ndarray):
-            state = torch.tensor(state, device='cpu').float().unsqueeze(0)
-        if state.get_device() != -1:
-            print("Device for state is not CPU")
-            state = state.cpu()
-        if mask.get_device() != -1:
-            print("Device for mask is not CPU")
-            mask = mask.cpu()
+        # VAEAC masks mark unobserved features with 1. The model is expected to be on CPU.
+        mask = 1.0 - torch.as_tensor(mask, dtype=torch.float32).unsqueeze(0)
+        state = torch.as_tensor(state, dtype=torch.float32).unsqueeze(0)
+        if not mask.any():
+            # Nothing to impute
+            return state.squeeze(0).numpy().copy()
 
         with torch.no_grad():            
             observed = self.make_observed(state, mask)            
 
-            prior_params = self.prior_network(torch.cat([observed, mask],1).cpu())
+            prior_params = self.prior_network(torch.cat([observed, mask], 1))
             prior = normal_parse_params(prior_params, 1e-3)
             latent = prior.rsample()
             sample_params = self.generative_network(latent)
             sample = self.sampler_network(sample_params)
-            sample = sample.squeeze(0).numpy()
-            mask = mask.squeeze(0).numpy()
-            state = state.squeeze(0).numpy()
-        mask = [1 - x for x in mask]
-        for i in range(len(sample)):
-            if mask[i] == 1: 
-                sample[i] = state[i]
-        return sample
+            sample = torch.where(mask.bool(), sample, state)
+        return sample.squeeze(0).numpy()
@@ -1,9 +1,26 @@
+import math
+
 import torch
 from torch.distributions import Categorical, Normal
 from torch.nn import Module
 from torch.nn.functional import softplus, softmax
 
 
+def normal_parse_mu_sigma(params, min_sigma=0):
+    """
+    Take a Tensor (e. g. neural network output) and return the mean
+    and the std (sigma) of a component-wise independent Normal distribution,
+    without building a torch.distributions.Normal object.
+    See normal_parse_params for the parametrization.
+    """
+    d = params.shape[1]
+    mu = params[:, :d // 2]
+    sigma_params = params[:, d // 2:]
+    sigma = softplus(sigma_params)
+    sigma = sigma.clamp(min=min_sigma)
+    return mu, sigma
+
+
 def normal_parse_params(params, min_sigma=0):
     """
     Take a Tensor (e. g. neural network output) and return
@@ -21,16 +38,29 @@ def normal_parse_params(params, min_sigma=0):
     as a neural network architecture choice without any change
     to the probabilistic model.
     """
-    n = params.shape[0]
-    d = params.shape[1]
-    mu = params[:, :d // 2]
-    sigma_params = params[:, d // 2:]
-    sigma = softplus(sigma_params)
-    sigma = sigma.clamp(min=min_sigma)
+    mu, sigma = normal_parse_mu_sigma(params, min_sigma)
     distr = Normal(mu, sigma)
     return distr
 
 
+def normal_log_prob(x, mu, sigma):
+    """
+    Component-wise log probability of x under Normal(mu, sigma),
+    the same as Normal(mu, sigma).log_prob(x).
+    """
+    return -((x - mu) / sigma) ** 2 / 2 - sigma.log() - math.log(math.sqrt(2 * math.pi))
+
+
+def normal_kl(mu_q, sigma_q, mu_p, sigma_p):
+    """
+    Component-wise closed-form KL divergence KL(Normal(mu_q, sigma_q) || Normal(mu_p, sigma_p)),
+    the same as kl_divergence for two torch.distributions.Normal objects.
+    """
+    var_ratio = (sigma_q / sigma_p) ** 2
+    t = ((mu_q - mu_p) / sigma_p) ** 2
+    return (var_ratio + t - 1 - var_ratio.log()) / 2
+
+
 def categorical_parse_params_column(params, min_prob=0):
     """
     Take a Tensor (e. g. a part of neural network output) and return